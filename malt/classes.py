@@ -8,8 +8,10 @@ indices as the pdb files.
 """
 
 import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property, partial
 import numpy as np
-import pandas as pd
 import pkg_resources
 from csv import reader
 from rdkit import Chem
@@ -54,7 +56,6 @@ class Molecule:
         self._mol2 = None
         self._pdb_mol = None
         self._xyz_mol = None
-        self.charges = None
         self.name = name
         self.num_bonds = None
         self.num_atoms = None
@@ -64,6 +65,12 @@ class Molecule:
         self.atoms = []
         self.smiles = None
         self.s_flag = False
+        self._atoms = None
+        self._bonds = None
+        self._symbols = None
+        self._indices = None
+        self._elements = None
+        self._elements_by_index = None
 
         # Initialise rdkit mol objects for the input files
         if len(args) > 0:
@@ -72,7 +79,7 @@ class Molecule:
                     continue
                 # Initialise xyz details
                     self._pdb_mol = Chem.MolFromPDBFile(path_to_pdb, removeHs=False)
-                    if self.name == None:
+                    if self.name is None:
                         self.name = os.path.basename(path_to_pdb)[:-4]
                         self.index = int(self.name[1:])
 
@@ -86,7 +93,7 @@ class Molecule:
                 print('chicken')
                 self._mol2 = mol2(path_to_mol2)
                 self._mol = Chem.MolFromMol2File(path_to_mol2, sanitize=False, removeHs=False)
-                if self.name == None:
+                if self.name is None:
                     self.name = path_to_mol2[:-5]
             elif CalculateCharges == False:
                 self._path_to_charges = arg
@@ -96,7 +103,7 @@ class Molecule:
                 self._mol2 = vehicle_mol2(arg)
                 self._mol =  self._mol2.mol_from_mol2()
                 self.s_flag = True
-                if self.name == None:
+                if self.name is None:
                     self.name = arg
 
             self.smiles = smiles
@@ -113,48 +120,98 @@ class Molecule:
             self._mol = self._pdb_mol
 
             # Set various attributes
-        self.num_bonds = len(self._mol.GetBonds())
-        self.num_atoms = len(self._mol.GetAtoms())
+        # Atoms and bonds are cached so that later blocks do not have to
+        # cross back into rdkit for them
+        self._atoms = list(self._mol.GetAtoms())
+        self._bonds = list(self._mol.GetBonds())
+        self._symbols = [atom.GetSymbol() for atom in self._atoms]
+        self._indices = np.arange(len(self._atoms))
+        self.num_bonds = len(self._bonds)
+        self.num_atoms = len(self._atoms)
 
-        # Set charges
-        self.set_charges()
+        # Charges are only worked out when first needed, see self.charges
 
         # Set smiles
         if self.smiles is None:
             self.smiles = Chem.MolToSmiles(self._mol)
 
+    def __getstate__(self):
+        # rdkit Atom and Bond objects cannot be pickled, they are taken from
+        # the (picklable) mol again when unpickling
+        state = self.__dict__.copy()
+        state['_atoms'] = None
+        state['_bonds'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._atoms = list(self._mol.GetAtoms())
+        self._bonds = list(self._mol.GetBonds())
+
+    @classmethod
+    def from_paths(cls, paths, n_jobs=None, **kwargs):
+        """
+        Builds a Molecule for every entry in paths, spread over n_jobs worker
+        processes (all cores by default). Each entry is a path, or a tuple of
+        paths as would be passed to Molecule(); kwargs are passed to every
+        Molecule. Returns the molecules in the same order as paths
+        """
+        build = partial(_build_molecule, cls, **kwargs)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(build, paths, chunksize=32))
+
     def set_charges(self):
         """
         Set the self.charge attribute - this depends on the charge information provided
         """
+        # Reading the cached_property is what works the charges out
+        _ = self.charges
 
-        if self.charges is not None:
-            return
+    @cached_property
+    def charges(self):
+        """
+        Partial charges of the atoms, ordered by atom index. These come from
+        the mol2 file if one was given, otherwise CalculateCharges selects
+        Gasteiger (True), MMFF94 ('MMFF') or an external file (False)
+        """
+        if self._mol2 is not None:
+            return np.asarray(self._mol2.get_charges(), dtype=np.float64)
 
-        elif self._mol2 is not None:
-            self.charges = self._mol2.get_charges()
-            return
         elif self._CalculateCharges is True:
             rdPartialCharges.ComputeGasteigerCharges(self._mol)
-            gasteiger_charges = []
-            for atom in self._mol.GetAtoms():
-                charge = float(atom.GetProp('_GasteigerCharge'))
-                gasteiger_charges.append(charge)
-            self.charges = gasteiger_charges
-            return
+            return np.fromiter(
+                (float(atom.GetProp('_GasteigerCharge'))
+                 for atom in self._atoms),
+                dtype=np.float64, count=self.num_atoms)
+
+        elif self._CalculateCharges == 'MMFF':
+            mmff_properties = AllChem.MMFFGetMoleculeProperties(self._mol)
+            if mmff_properties is None:
+                molecule = self.name or self.path_to_xyz or self.smiles
+                raise ValueError(f'MMFF94 parameters are not available for '
+                                 f'{molecule}')
+            return np.fromiter(
+                (mmff_properties.GetMMFFPartialCharge(idx)
+                 for idx in range(self.num_atoms)),
+                dtype=np.float64, count=self.num_atoms)
+
         else:
-            self.get_external_charges(self._path_to_charges)
-            return
+            return self._read_external_charges(self._path_to_charges)
 
     def elements(self):
         """
         Returns a list of all the elements present in the input molecule,
         in increasing atomic number order with H last
         """
+        # The atoms of a Molecule never change, so this is only worked out
+        # once. Callers get a copy so they cannot alter the cached order
+        if self._elements is not None:
+            return list(self._elements)
+
         element_dict = {}
-        for atom in self._mol.GetAtoms():
-            if atom.GetSymbol() not in element_dict:
-                element_dict[atom.GetSymbol()] = atom.GetAtomicNum()
+        for atom, symbol in zip(self._atoms, self._symbols):
+            if symbol not in element_dict:
+                element_dict[symbol] = atom.GetAtomicNum()
 
         # Now sort dictionary into TRIPOS format - increasing atomic no.
         # with H at the end
@@ -164,19 +221,22 @@ class Molecule:
         if 'H' in elements:
             elements.remove('H')
             elements.append('H')
-        return elements
+
+        self._elements = elements
+        return list(elements)
 
     def elements_by_index(self):
         """
         Returns a dictionary with element symbols as keys, and the atom ID's of those elements in the molecule as values
         """
-        mol_by_elements = {}
-        for atom in self._mol.GetAtoms():
-            symbol = atom.GetSymbol()
-            if symbol not in mol_by_elements:
-                mol_by_elements[symbol] = []
-            mol_by_elements[symbol].append(atom.GetIdx())
-        return mol_by_elements
+        if self._elements_by_index is None:
+            mol_by_elements = defaultdict(list)
+            for idx, symbol in zip(self._indices, self._symbols):
+                mol_by_elements[symbol].append(int(idx))
+            self._elements_by_index = dict(mol_by_elements)
+
+        return {symbol: list(indices)
+                for symbol, indices in self._elements_by_index.items()}
 
     def get_external_charges(self, filename):
         """
@@ -185,28 +245,44 @@ class Molecule:
         charges returns charges - list of atomic partial charges for the
         molecule
         """
-        with open(filename, 'r') as file:
-            csv_reader = reader(file)
-            all_charges = list(csv_reader)
+        self.charges = self._read_external_charges(filename)
 
+        return None
+
+    def _read_external_charges(self, filename):
+        """
+        Returns the row of partial charges for this molecule from filename
+        """
         if self.index is None:
             index = 1
         else:
             index = self.index
 
-        self.charges = all_charges[index - 1]
-        self.charges = [float(charge) for charge in self.charges]
+        # Only read as far as the row for this molecule
+        with open(filename, 'r') as file:
+            for row_number, row in enumerate(reader(file), 1):
+                if row_number == index:
+                    return np.asarray(row, dtype=np.float64)
 
-        return None
+        raise IndexError(f'{filename} has no charges for molecule {index}')
 
-    @property
+    @cached_property
     def coords(self):
         # Set up coordinates. If xyz file is present then these coordinates
-        # are used over .pdb
+        # are used over .pdb. Stored once as a contiguous N x 3 array
         if self._xyz_mol is not None:
-            return self._xyz_mol.GetConformer(0).GetPositions()
+            positions = self._xyz_mol.GetConformer(0).GetPositions()
         else:
-            return self._mol.GetConformer(0).GetPositions()
+            positions = self._mol.GetConformer(0).GetPositions()
+        return np.ascontiguousarray(positions, dtype=np.float64)
+
+    def pairwise_distances(self):
+        """
+        Returns the N x N matrix of distances between all pairs of atoms,
+        ordered by atom index
+        """
+        coords = self.coords
+        return np.sqrt(((coords[:, None, :] - coords) ** 2).sum(axis=-1))
 
     def molecule_block(self):
         """
@@ -221,6 +297,8 @@ class Molecule:
 
         if self._CalculateCharges is True:
             charge_type = 'GASTEIGER'
+        elif self._CalculateCharges == 'MMFF':
+            charge_type = 'MMFF94_CHARGES'
         else:
             charge_type = 'DFT'
 
@@ -232,6 +310,111 @@ class Molecule:
 
         return molecule_block
 
+    def _atom_order(self):
+        """
+        Returns the label of each atom within its element (e.g. the third
+        carbon is C3), the permutation putting atoms in TRIPOS order, and the
+        RDKit index -> TRIPOS atom ID mapping needed for the bond block
+        """
+        mol_by_elements = self.elements_by_index()
+
+        # Built once so that labels do not need a list.index scan per atom
+        rank = {}
+        for element_indices in mol_by_elements.values():
+            for element_rank, idx in enumerate(element_indices, 1):
+                rank[idx] = element_rank
+        atom_index_labels = np.array([rank[idx] for idx in self._indices])
+
+        # Sort by element (in TRIPOS element order), then by atom index label
+        element_order = {symbol: i for i, symbol in enumerate(self.elements())}
+        element_keys = np.array([element_order[symbol]
+                                 for symbol in self._symbols], dtype=np.int8)
+        perm = np.lexsort((atom_index_labels, element_keys))
+
+        # TRIPOS atom ID and RDKit index are not the same, need to generate
+        # a mapping from one to t'other, indexed by RDKit index
+        rdkit_to_tripos = np.empty(self.num_atoms, dtype=np.int32)
+        rdkit_to_tripos[self._indices[perm]] = np.arange(1, len(perm) + 1)
+
+        return atom_index_labels, perm, rdkit_to_tripos
+
+    def _atom_lines(self, atom_index_labels, perm):
+        """
+        Returns the lines of the ATOM block, in TRIPOS order, as one string
+        """
+        # Pull everything needed from rdkit up front
+        charges = np.asarray(self.charges, dtype=np.float64)
+        symbols = self._symbols
+        hybs = [str(atom.GetHybridization()) for atom in self._atoms]
+
+        # Atom names, coordinates and charges are formatted as whole columns
+        symbol_arr = np.asarray(symbols)
+        atom_names = np.char.add(symbol_arr, atom_index_labels.astype(str))
+        x, y, z = np.ascontiguousarray(self.coords.T)
+        x_strs = np.char.mod('%.4f', x)
+        y_strs = np.char.mod('%.4f', y)
+        z_strs = np.char.mod('%.4f', z)
+        charge_strs = np.char.mod('%.3f', charges)
+
+        # Generate the sybyl code for each atom - the symbol, and the
+        # atom type e.g. aromatic, sp3 etc. - for the whole molecule at once
+        aromatic = np.array([atom.GetIsAromatic() for atom in self._atoms],
+                            dtype=bool)
+        is_hydrogen = symbol_arr == 'H'
+        is_aromatic_cn = aromatic & np.isin(symbol_arr, ['C', 'N'])
+
+        # Only atoms that are neither H nor aromatic C/N take their type
+        # from the hybridisation, so an unmapped hybridisation is still an
+        # error for those atoms rather than a silently truncated type
+        needs_hyb = ~(is_hydrogen | is_aromatic_cn)
+        hyb_codes = np.array([atom_types[hyb] if needed else ''
+                              for hyb, needed in zip(hybs, needs_hyb)],
+                             dtype=str)
+        sybyls = np.where(
+            is_aromatic_cn, np.char.add(symbol_arr, '.ar'),
+            np.where(is_hydrogen, 'H',
+                     np.char.add(np.char.add(symbol_arr, '.'), hyb_codes)))
+
+        # Format each line directly rather than through DataFrame.to_string
+        atom_lines = [
+            f'{i:>6} {name:<8} {x:>10} {y:>10} {z:>10} {sybyl:<6} {q:>8}'
+            for i, (name, x, y, z, sybyl, q) in enumerate(zip(
+                atom_names[perm], x_strs[perm], y_strs[perm], z_strs[perm],
+                sybyls[perm], charge_strs[perm]), 1)]
+
+        return '\n'.join(atom_lines) + '\n'
+
+    def _bond_lines(self, rdkit_to_tripos):
+        """
+        Returns the lines of the BOND block, in TRIPOS order, as one string
+        """
+        # Get bond ends and convert to TRIPOS bond type from rdkit bond type
+        bonds = self._bonds
+        begin = np.fromiter((bond.GetBeginAtomIdx() for bond in bonds),
+                            dtype=np.int32, count=len(bonds))
+        end = np.fromiter((bond.GetEndAtomIdx() for bond in bonds),
+                          dtype=np.int32, count=len(bonds))
+        bond_type = np.array([bond_types[str(bond.GetBondType())]
+                              for bond in bonds], dtype=str)
+
+        # Convert RDKit indices to TRIPOS atom ID numbers so there is
+        # consistency between ATOM block and BOND block
+        tripos_begin = rdkit_to_tripos[begin]
+        tripos_end = rdkit_to_tripos[end]
+
+        # Sort by bond type (in the order of bond_types), then by first atom
+        type_order = {code: i for i, code in enumerate(bond_types.values())}
+        type_keys = np.array([type_order[code] for code in bond_type],
+                             dtype=np.int8)
+        perm = np.lexsort((tripos_begin, type_keys))
+
+        bond_lines = [
+            f'{i:>6} {b:>5} {e:>5} {t:>3}'
+            for i, (b, e, t) in enumerate(zip(
+                tripos_begin[perm], tripos_end[perm], bond_type[perm]), 1)]
+
+        return '\n'.join(bond_lines) + '\n'
+
     def atom_block(self):
         """
         Computes and returns, in the correct format, the '@<TRIPOS>ATOM
@@ -244,74 +427,9 @@ class Molecule:
 
             return atom_block
 
-        tripos_atom = pd.DataFrame(
-            columns=['rdkit_index', 'atom_name', 'x_coord', 'y_coord',
-                     'z_coord', 'sybyl', 'substruct', 'substruct_name',
-                     'partial_charge', 'atom_symbol', 'atom_index_label'])
+        atom_index_labels, perm, _ = self._atom_order()
 
-        mol_by_elements = self.elements_by_index()
-        substruct_name = self.name
-
-        for atom in self._mol.GetAtoms():
-
-            idx = atom.GetIdx()
-            symbol = atom.GetSymbol()
-            charge = self.charges[idx]
-
-            # Get co-ordinates for each atom
-            x_coord = self.coords[idx][0]
-            y_coord = self.coords[idx][1]
-            z_coord = self.coords[idx][2]
-
-            atom_index_label = mol_by_elements[symbol].index(idx) + 1
-            atom_name = f'{symbol}{atom_index_label}'
-
-            # Generate the sybyl code for each atom - the symbol, and the
-            # atom type e.g. aromatic, sp3 etc.
-            if symbol == 'C' or symbol == 'N':
-                if atom.GetIsAromatic():
-                    sybyl = f'{symbol}.ar'
-                else:
-                    sybyl = f'{symbol}.{atom_types[str(atom.GetHybridization())]}'
-            elif symbol == 'H':
-                sybyl = 'H'
-            else:
-                sybyl = f'{symbol}.{atom_types[str(atom.GetHybridization())]}'
-
-            # Append atom to dataframe of atomic information
-            tripos_atom = tripos_atom.append(
-                {'rdkit_index': idx, 'atom_name': atom_name,
-                 'x_coord': x_coord,
-                 'y_coord': y_coord, 'z_coord': z_coord,
-                 'sybyl': sybyl, 'substruct': NO_SUBSTRUCTS,
-                 'substruct_name': substruct_name,
-                 'partial_charge': "%.3f" % charge,
-                 'atom_symbol': symbol, 'atom_index_label': atom_index_label},
-                ignore_index=True)
-
-        # Sort dataframe by sybyl (elements first, followed by atom index label
-        tripos_atom['atom_symbol'] = pd.Categorical(tripos_atom['atom_symbol'],
-                                                    self.elements())
-        tripos_atom = tripos_atom.sort_values(
-            by=['atom_symbol', 'atom_index_label'])
-        tripos_atom.index = np.arange(1, len(tripos_atom) + 1)
-
-        # TRIPOS atom ID and RDKit index are not the same, need to generate
-        # a mapping from one to t'other
-        index_mapper = pd.DataFrame(data=np.arange(1, len(tripos_atom) + 1),
-                                    index=tripos_atom['rdkit_index'])
-        global index_lookup
-        index_lookup = index_mapper.to_dict()[0]
-
-        # Generate final dataframe, and return as a string
-        atom_block_df = tripos_atom[['atom_name', 'x_coord',
-                                     'y_coord', 'z_coord', 'sybyl',
-                                     'partial_charge']]
-
-        atom_block = '@<TRIPOS>ATOM\n' + atom_block_df.to_string(
-            header=False) + '\n'
-
-        return atom_block
+        return '@<TRIPOS>ATOM\n' + self._atom_lines(atom_index_labels, perm)
 
     def bond_block(self):
 
@@ -320,38 +438,29 @@ class Molecule:
 
             return bond_block
 
-        tripos_bond = pd.DataFrame(
-            columns=['begin_atom_rdkit', 'end_atom_rdkit', 'bond_type'])
+        # The TRIPOS atom IDs come from the atom ordering
+        _, _, rdkit_to_tripos = self._atom_order()
 
-        for index, bond in enumerate(self._mol.GetBonds()):
-            beginning = bond.GetBeginAtom().GetIdx()
-            end = bond.GetEndAtom().GetIdx()
+        return '@<TRIPOS>BOND\n' + self._bond_lines(rdkit_to_tripos)
 
-            # Get bond type and convert to TRIPOS bond type from rdkit bond
-            # type
-            bond_type = str(bond.GetBondType())
-            bond_type = bond_types[bond_type]
-
-            tripos_bond = tripos_bond.append(
-                {'begin_atom_rdkit': beginning, 'end_atom_rdkit': end,
-                 'bond_type': bond_type}, ignore_index=True)
-
-        # Convert RDKit indices to TRIPOS atom ID numbers so there is
-        # consistency between ATOM block and BOND block
-        tripos_bond['begin'] = tripos_bond.apply(
-            lambda row: index_lookup[row.begin_atom_rdkit], axis=1)
-        tripos_bond['end'] = tripos_bond.apply(
-            lambda row: index_lookup[row.end_atom_rdkit], axis=1)
-        tripos_bond['bond_type'] = pd.Categorical(tripos_bond['bond_type'],
-                                                  list(bond_types.values()))
-        tripos_bond = tripos_bond.sort_values(by=['bond_type', 'begin'])
-        tripos_bond.index = np.arange(1, len(tripos_bond) + 1)
-        tripos_bond = tripos_bond[['begin', 'end', 'bond_type']]
+    def mol2_body(self):
+        """
+        Returns the MOLECULE, ATOM and BOND blocks for the instance of the
+        molecule as one string. The atom ordering is worked out once and
+        shared between the ATOM and BOND blocks
+        """
+        if self.s_flag is True:
+            return (self._mol2.get_molecule_block()
+                    + self._mol2.get_atom_block()
+                    + self._mol2.get_bond_block())
 
-        bond_block = '@<TRIPOS>BOND\n' + tripos_bond.to_string(
-            header=False) + '\n'
+        atom_index_labels, perm, rdkit_to_tripos = self._atom_order()
 
-        return bond_block
+        return ''.join([self.molecule_block(),
+                        '@<TRIPOS>ATOM\n',
+                        self._atom_lines(atom_index_labels, perm),
+                        '@<TRIPOS>BOND\n',
+                        self._bond_lines(rdkit_to_tripos)])
 
     def print_mol2_file(self, filename=None):
         """
@@ -365,9 +474,21 @@ class Molecule:
         else:
             file_name = f'{filename}.mol2'
 
-        block = self.molecule_block() + self.atom_block() + self.bond_block()
+        block = self.mol2_body()
 
         with open(file_name, 'w') as file:
             file.write(block)
 
         return None
+
+
+def _build_molecule(cls, paths, **kwargs):
+    """
+    Worker for Molecule.from_paths - builds one molecule from a path or a
+    tuple of paths. Charges are set here so they are worked out in the worker
+    """
+    if not isinstance(paths, (tuple, list)):
+        paths = (paths,)
+    molecule = cls(*paths, **kwargs)
+    molecule.set_charges()
+    return molecule
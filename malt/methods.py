@@ -13,7 +13,7 @@ def molecule_block(*args, **kwargs):
     Generates the TRIPOS Mol2 block for a given molecule, returned as a string
     """
     mol = Molecule(*args, **kwargs)
-    block = mol.molecule_block() + mol.atom_block() + mol.bond_block() + '\n'
+    block = mol.mol2_body() + '\n'
 
     return block
 